@@ -1,12 +1,20 @@
 """Local support for Mill wifi-enabled home heaters."""
-import json
+import asyncio
+import functools
+import ipaddress
 import logging
+import random
+import statistics
+import time
+from collections import deque
+from contextlib import asynccontextmanager
 from enum import Enum
-from typing import Union
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple, Union
 
 import aiohttp.client_exceptions
-from aiohttp import ClientSession
-from async_timeout import timeout
+import orjson
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from yarl import URL
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -27,6 +35,12 @@ class OperationMode(Enum):
     INDEPENDENT_DEVICE = "Independent device"
 
 
+# Serialized once, since the operation mode payloads never change
+_MODE_BODIES = {mode: orjson.dumps({"mode": mode.value}) for mode in OperationMode}
+# Sent with already serialized bodies, which would otherwise go out as application/octet-stream
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
 class OilHeaterPowerLevels(Enum):
     """Heater power setting by percentage."""
 
@@ -36,16 +50,222 @@ class OilHeaterPowerLevels(Enum):
     OFF = 0
 
 
+def _json_dumps(obj) -> str:
+    """Serialize to JSON with orjson, as the str aiohttp expects from json_serialize."""
+    return orjson.dumps(obj).decode()
+
+
+async def _backoff(delay: float) -> None:
+    """Wait before the next attempt of a failed request."""
+    await asyncio.sleep(delay)
+
+
+def _status_message(body: bytes) -> str:
+    """Return the status message of an error response body, which may be empty or not even JSON."""
+    try:
+        return orjson.loads(body).get("status", "")
+    except (orjson.JSONDecodeError, AttributeError):
+        return ""
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    """Request skipped since the heater has stopped responding."""
+
+
+class _CircuitState(Enum):
+    """Circuit breaker state."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class _CircuitBreaker:
+    """Fail fast after repeated connection errors, and probe the heater again after a cool-down.
+
+    Used as an async context manager around a single request.
+    """
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30) -> None:
+        """Init circuit breaker."""
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = _CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent, letting a single probe through after the cool-down."""
+        if self.state is _CircuitState.CLOSED:
+            return True
+        now = time.monotonic()
+        # A probe that never reported back (e.g. cancelled) is replaced after another cool-down
+        if now - self._opened_at < self.recovery_timeout:
+            return False
+        self.state = _CircuitState.HALF_OPEN
+        self._opened_at = now
+        return True
+
+    def record_success(self) -> None:
+        """Close the circuit."""
+        self.state = _CircuitState.CLOSED
+        self._failures = 0
+
+    def record_failure(self) -> None:
+        """Count a failure, opening the circuit at the threshold or when the probe fails."""
+        self._failures += 1
+        if self.state is _CircuitState.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state is _CircuitState.CLOSED:
+                _LOGGER.warning("Heater is not responding, pausing requests for %s seconds", self.recovery_timeout)
+            self.state = _CircuitState.OPEN
+            self._opened_at = time.monotonic()
+
+    async def __aenter__(self) -> None:
+        if not self.allow():
+            raise CircuitOpenError("Heater is not responding, request skipped")
+
+    async def __aexit__(self, exc_type, exc, traceback) -> bool:
+        # An HTTP error response still means the heater is reachable
+        if exc_type is None or issubclass(exc_type, aiohttp.ClientResponseError):
+            self.record_success()
+        elif issubclass(exc_type, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            self.record_failure()
+        return False
+
+
+class _AdaptiveTimeout:
+    """Per command timeout of twice the p95 latency of recent successful requests.
+
+    The timeout stays between floor and cap, and is only updated when it moves by more than 10%, so the
+    same ClientTimeout instance is reused by most requests. A timed out request doubles the timeout, up to the
+    cap, since a too short timeout would otherwise never see a successful request to learn from.
+    """
+
+    def __init__(self, cap: float, floor: float = 1.0, samples: int = 64, min_samples: int = 20) -> None:
+        """Init adaptive timeout."""
+        self.cap = cap
+        self.floor = floor
+        self._samples = samples
+        self._min_samples = min_samples
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._default_timeout = self._client_timeout(cap)
+        self._timeouts: Dict[str, ClientTimeout] = {}
+
+    @staticmethod
+    def _client_timeout(total: float) -> ClientTimeout:
+        return ClientTimeout(total=total, connect=min(total, 2), sock_read=total)
+
+    def get(self, command: str) -> ClientTimeout:
+        """Return the timeout for a command."""
+        return self._timeouts.get(command, self._default_timeout)
+
+    def record(self, command: str, latency: float) -> None:
+        """Record the latency of a successful request."""
+        latencies = self._latencies.setdefault(command, deque(maxlen=self._samples))
+        latencies.append(latency)
+        if len(latencies) < self._min_samples:
+            return
+        p95 = statistics.quantiles(latencies, n=20)[18]
+        new_timeout = min(self.cap, max(2 * p95, self.floor))
+        current_timeout = self.get(command).total
+        if abs(new_timeout - current_timeout) > 0.1 * current_timeout:
+            self._timeouts[command] = self._client_timeout(new_timeout)
+
+    def record_timeout(self, command: str) -> None:
+        """Double the timeout of a command that timed out, up to the cap."""
+        new_timeout = 2 * self.get(command).total
+        if new_timeout < self.cap:
+            self._timeouts[command] = self._client_timeout(new_timeout)
+        else:
+            self._timeouts.pop(command, None)
+
+    @asynccontextmanager
+    async def measure(self, command: str, time_left: Optional[float] = None) -> AsyncIterator[ClientTimeout]:
+        """Provide the timeout for a request, recording its latency if successful or widening it on timeout.
+
+        The timeout is shortened to time_left, if given and shorter.
+        """
+        timeout = self.get(command)
+        if time_left is not None and time_left < timeout.total:
+            timeout = self._client_timeout(time_left)
+        start = time.monotonic()
+        try:
+            yield timeout
+        except asyncio.TimeoutError:
+            self.record_timeout(command)
+            raise
+        self.record(command, time.monotonic() - start)
+
+
 class Mill:
     """Mill data handler."""
 
     def __init__(self, device_ip: str, websession: ClientSession, timeout_seconds: int = 15) -> None:
-        """Init Mill data handler."""
+        """Init Mill data handler.
+
+        The websession should be long-lived (one per application, not one per request), so that its
+        connection pool can keep the connection to the heater alive between polls.
+        """
         self.device_ip = device_ip.replace("http://", "").replace("/", "").strip()
+        # Raises ValueError for anything but an IP address, which also means no DNS lookups are needed
+        ipaddress.ip_address(self.device_ip)
         self.websession = websession
-        self.url = "http://" + self.device_ip
+        self._base_url = URL.build(scheme="http", host=self.device_ip)
+        self._urls = {
+            command: self._base_url / command
+            for command in ("status", "control-status", "set-temperature", "operation-mode")
+        }
         self._timeout_seconds = timeout_seconds
+        self._timeout = _AdaptiveTimeout(cap=timeout_seconds)
         self._status = {}
+        # The status (name, version, MAC address) changes rarely, so it is cached for a short while
+        self._status_ttl = 5.0
+        self._status_cached_at: Optional[float] = None
+        self._last_target_temperature: Optional[float] = None
+        self._owns_session = False
+        self._breaker = _CircuitBreaker()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # Limits concurrent requests, since the heater's web server is easily overwhelmed
+        self._semaphore = asyncio.Semaphore(2)
+
+    @classmethod
+    def create(cls, device_ip: str, timeout_seconds: int = 15) -> "Mill":
+        """Create a Mill data handler with its own keep-alive websession.
+
+        Must be called from within the running event loop. Call close() when done.
+        """
+        connector = TCPConnector(
+            limit_per_host=2,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            force_close=False,
+        )
+        websession = ClientSession(
+            connector=connector,
+            connector_owner=True,
+            json_serialize=_json_dumps,
+            # The heater does not compress its small responses, so do not ask for it
+            headers={"Accept-Encoding": "identity", "Connection": "keep-alive"},
+        )
+        mill = cls(device_ip, websession, timeout_seconds)
+        mill._owns_session = True
+        return mill
+
+    async def close(self) -> None:
+        """Close the websession if it was created by this data handler."""
+        if self._owns_session:
+            await self.websession.close()
+
+    @property
+    def url(self) -> str:
+        """Return the base URL of the local API."""
+        return str(self._base_url)
+
+    @url.setter
+    def url(self, url: str) -> None:
+        """Set the base URL of the local API."""
+        self._base_url = URL(url)
+        self._urls.clear()
 
     @property
     def version(self) -> str:
@@ -63,8 +283,14 @@ class Mill:
         return self._status.get("mac_address")
 
     async def set_target_temperature(self, target_temperature: float) -> None:
-        """Set target temperature."""
-        _LOGGER.debug("Setting target temperature to: '%s'", target_temperature)
+        """Set target temperature, unless it is the same as the last one set."""
+        if target_temperature == self._last_target_temperature:
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug("Target temperature is already: '%s'", target_temperature)
+            return
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Setting target temperature to: '%s'", target_temperature)
+        self._last_target_temperature = None
         await self._post_request(
             command="set-temperature",
             payload={
@@ -72,6 +298,7 @@ class Mill:
                 "value": target_temperature,
             }
         )
+        self._last_target_temperature = target_temperature
 
     async def set_operation_mode_control_individually(self) -> None:
         """Set operation mode to 'control individually'."""
@@ -82,36 +309,100 @@ class Mill:
         await self._set_operation_mode(OperationMode.OFF)
 
     async def connect(self) -> dict:
-        """Connect to the device and return its status."""
+        """Connect to the device and return its status.
+
+        Always sends a request, bypassing the status cache, so an unreachable heater is reported at setup
+        and the keep-alive connection is open for the following polls.
+        """
+        self._status_cached_at = None
         return await self.get_status()
 
     async def get_status(self) -> dict:
-        """Get status summary of the device."""
-        self._status = await self._get_request("status")
+        """Get status summary of the device, cached for a few seconds."""
+        if self._status_cached_at is not None and time.monotonic() - self._status_cached_at < self._status_ttl:
+            return self._status
+        self._status = await self._request_with_retry(functools.partial(self._get_request, "status"))
+        self._status_cached_at = time.monotonic()
         return self._status
 
     async def fetch_heater_and_sensor_data(self) -> dict:
         """Get current heater state and control status."""
-        return await self._get_request("control-status")
+        control_status = await self._request_with_retry(functools.partial(self._get_request, "control-status"))
+        # The target temperature may have been changed on the device itself
+        if control_status.get("set_temperature") != self._last_target_temperature:
+            self._last_target_temperature = None
+        return control_status
+
+    async def fetch_all(self) -> Tuple[dict, dict]:
+        """Get status summary and current heater state concurrently."""
+        status, control_status = await asyncio.gather(self.get_status(), self.fetch_heater_and_sensor_data())
+        return status, control_status
+
+    async def _request_with_retry(
+            self,
+            coro_factory: Callable[[Optional[float]], Awaitable[dict]],
+            *,
+            attempts: int = 4,
+            base: float = 0.1,
+            cap: float = 1.0
+    ) -> dict:
+        """Run an idempotent request, retrying connection errors and timeouts.
+
+        Waits a random time between 0 and min(cap, base * 2 ** attempt) seconds between attempts (full jitter),
+        so several clients do not retry against a flaky heater in lockstep. HTTP error responses are not
+        retried, and neither should non-idempotent POST requests be.
+
+        All attempts share the configured timeout: coro_factory is called with the seconds left of it for a
+        retry, and no retry is started with less than the minimum request timeout left.
+        """
+        deadline = time.monotonic() + self._timeout_seconds
+        for attempt in range(attempts):
+            # The first attempt has all the time, so it keeps the timeout instance of the command
+            time_left = deadline - time.monotonic() if attempt else None
+            try:
+                return await coro_factory(time_left)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                delay = random.uniform(0, min(cap, base * 2 ** attempt))  # noqa: S311
+                if attempt == attempts - 1 or time.monotonic() + delay + self._timeout.floor > deadline:
+                    raise
+                _LOGGER.debug("Request failed, retrying in %.2f seconds", delay)
+                await _backoff(delay)
 
     async def _set_operation_mode(self, mode: OperationMode) -> None:
         """Set heater operation mode."""
-        _LOGGER.debug("Setting operation mode to: '%s'", mode.value)
-        await self._post_request(command="operation-mode", payload={"mode": mode.value})
-
-    async def _post_request(self, command: str, payload: dict) -> None:
-        """HTTP POST request to Mill Local Api."""
-        async with timeout(self._timeout_seconds):
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Setting operation mode to: '%s'", mode.value)
+        self._last_target_temperature = None
+        await self._post_request(command="operation-mode", payload=_MODE_BODIES[mode])
+
+    def _url(self, command: str) -> URL:
+        """Return the full URL of a command, building it only once."""
+        url = self._urls.get(command)
+        if url is None:
+            url = self._urls[command] = self._base_url / command
+        return url
+
+    async def _post_request(self, command: str, payload: Union[dict, bytes]) -> None:
+        """HTTP POST request to Mill Local Api.
+
+        The payload is either an already serialized body, or a dict serialized by the json_serialize
+        function of the websession.
+        """
+        if isinstance(payload, bytes):
+            body_kwargs = {"data": payload, "headers": _JSON_HEADERS}
+        else:
+            body_kwargs = {"json": payload}
+
+        # Any write may change the device state, so do not serve a cached status after it
+        self._status_cached_at = None
+        async with self._semaphore, self._breaker, self._timeout.measure(command) as timeout:
             async with self.websession.post(
-                    url=f"{self.url}/{command}",
-                    data=json.dumps(payload)
+                    url=self._url(command),
+                    timeout=timeout,
+                    **body_kwargs
             ) as response:
                 # Since body is not available when using raise_for_status=True, we use raise_for_status()
-                json_response = await response.json()
-
-                # Guard in case response body is missing and Error is raised
-                if json_response is None:
-                    json_response = {"status": ""}
+                body = await response.read()
 
                 try:
                     response.raise_for_status()
@@ -121,43 +412,78 @@ class Mill:
                         command,
                         response.status,
                         response.reason,
-                        json_response.get("status", "")  # Guard in case status property is missing in body
+                        _status_message(body)
                     )
                     raise
 
-    async def _get_request(self, command: str) -> Union[dict, None]:
-        """HTTP GET request to Mill Local Api."""
-        async with timeout(self._timeout_seconds):
+    async def _get_request(self, command: str, time_left: Optional[float] = None) -> dict:
+        """HTTP GET request to Mill Local Api.
+
+        Concurrent callers of the same command share a single request to the heater, limited to the time left
+        of the first caller.
+        """
+        task = self._inflight.get(command)
+        if task is None:
+            task = asyncio.create_task(self._send_get_request(command, time_left))
+            self._inflight[command] = task
+            task.add_done_callback(functools.partial(self._get_request_done, command))
+        # Shielded, so a cancelled caller does not cancel the request for the other callers
+        return await asyncio.shield(task)
+
+    def _get_request_done(self, command: str, task: asyncio.Task) -> None:
+        """Forget a finished GET request."""
+        self._inflight.pop(command, None)
+        # Retrieve the exception, which would otherwise be logged as never retrieved if all callers were cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def _send_get_request(self, command: str, time_left: Optional[float] = None) -> dict:
+        """Send HTTP GET request to Mill Local Api."""
+        async with self._semaphore, self._breaker, self._timeout.measure(command, time_left) as timeout:
             async with self.websession.get(
-                    url=f"{self.url}/{command}"
+                    url=self._url(command),
+                    timeout=timeout
             ) as response:
                 # Since body is not available when using raise_for_status=True, we use raise_for_status()
-                json_response = await response.json()
-
-                # Guard in case response body is missing and Error is raised
-                if json_response is None:
-                    json_response = {"status": ""}
+                body = await response.read()
 
                 try:
                     response.raise_for_status()
-                    return json_response
                 except aiohttp.ClientResponseError:
                     _LOGGER.error(
                         "GET request to '%s' failed with status code: '%s (%s)' and status message: '%s'",
                         command,
                         response.status,
                         response.reason,
-                        json_response.get("status", "")  # Guard in case status property is missing in body
+                        _status_message(body)
                     )
                     raise
 
+                try:
+                    data = orjson.loads(body) if body else None
+                except orjson.JSONDecodeError as err:
+                    # Raised as the ClientResponseError aiohttp's response.json() raises for a non-JSON response
+                    raise aiohttp.ContentTypeError(
+                        response.request_info,
+                        response.history,
+                        status=response.status,
+                        message=f"Invalid JSON response body: {err}",
+                        headers=response.headers
+                    ) from err
+
+                # Guard in case response body is missing or null
+                if data is None:
+                    return {"status": ""}
+                return data
+
 
 class MillOilHeater(Mill):
     """Mill Oil Heater data handler."""
 
     async def set_heater_power(self, power: OilHeaterPowerLevels) -> None:
         """Set oil oven heater power"""
-        _LOGGER.debug("Setting oil oven heater power to: '%s'", power.value)
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Setting oil oven heater power to: '%s'", power.value)
         await self._post_request(
             command="oil-heater-power",
             payload={
@@ -167,4 +493,4 @@ class MillOilHeater(Mill):
 
     async def fetch_heater_power_data(self) -> dict:
         """Get current heater state and control status."""
-        return await self._get_request("oil-heater-power")
+        return await self._request_with_retry(functools.partial(self._get_request, "oil-heater-power"))
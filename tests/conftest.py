@@ -1,25 +1,124 @@
 """Test helpers """
 
-import json
+import asyncio
+import functools
 import pathlib
+import sys
+from collections import defaultdict
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
+import orjson
 import pytest
-from aiohttp import ClientSession
-from aioresponses import aioresponses
-
-
-# See https://github.com/pnuckowski/aioresponses/issues/218
-@pytest.fixture
-def mocked_response():
-    with aioresponses() as m:
-        yield m
-
-
-@pytest.fixture(autouse=True)
+import pytest_asyncio
+from aiohttp import ClientSession, TCPConnector, web
+from aiohttp.test_utils import TestServer
+
+from mill_local import Mill
+
+
+def pytest_configure(config):
+    """Run the tests on uvloop, which has less overhead than the default event loop."""
+    if sys.platform != "win32":
+        import uvloop  # pylint: disable=import-outside-toplevel
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+class FakeHeater:
+    """In-process stand-in for the local REST API of a heater.
+
+    Responses are queued per method and command and served in order; requests without a queued response get
+    a 404. Received requests are recorded with their content type and their JSON body parsed.
+    """
+
+    def __init__(self) -> None:
+        app = web.Application()
+        app.router.add_route("*", "/{command}", self._handle)
+        self.server = TestServer(app)
+        self.requests: List[Tuple[str, str, str, Any]] = []
+        self._responses: Dict[Tuple[str, str], List[dict]] = defaultdict(list)
+
+    def add(
+            self,
+            method: str,
+            command: str,
+            status: int = 200,
+            payload: Any = None,
+            body: Union[bytes, str, None] = None,
+            content_type: str = "application/json",
+            disconnect: bool = False,
+            callback: Optional[Callable[[], Awaitable[None]]] = None,
+            repeat: bool = False,
+    ) -> None:
+        """Queue a response, or a dropped connection when disconnect is set.
+
+        A payload is encoded once here, so repeated responses are served from the same bytes. Read-only JSON
+        fixtures are encoded as the dicts they wrap.
+        """
+        self._responses[(method, command)].append({
+            "status": status,
+            "body": orjson.dumps(payload, default=dict) if payload is not None else body,
+            "content_type": content_type,
+            "disconnect": disconnect,
+            "callback": callback,
+            "repeat": repeat,
+        })
+
+    def get(self, command: str, **kwargs) -> None:
+        """Queue a response to a GET request."""
+        self.add("GET", command, **kwargs)
+
+    def post(self, command: str, **kwargs) -> None:
+        """Queue a response to a POST request."""
+        self.add("POST", command, **kwargs)
+
+    def clear(self) -> None:
+        """Remove all queued responses."""
+        self._responses.clear()
+
+    def calls(self, method: str, command: str) -> int:
+        """Return the number of requests received for a command."""
+        return sum(1 for request in self.requests if request[:2] == (method, command))
+
+    def attach(self, mill: Mill) -> Mill:
+        """Point a Mill data handler at this heater."""
+        mill.url = str(self.server.make_url(""))
+        return mill
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        command = request.match_info["command"]
+        body = await request.read()
+        self.requests.append((request.method, command, request.content_type, orjson.loads(body) if body else None))
+
+        queue = self._responses.get((request.method, command))
+        if not queue:
+            return web.Response(status=404)
+        response = queue[0] if queue[0]["repeat"] else queue.pop(0)
+
+        if response["callback"] is not None:
+            await response["callback"]()
+        if response["disconnect"]:
+            request.transport.close()
+        return web.Response(status=response["status"], body=response["body"], content_type=response["content_type"])
+
+
+@pytest_asyncio.fixture
+async def heater():
+    """A fake heater, served on a fresh port so no test reuses the connections of another."""
+    heater = FakeHeater()
+    await heater.server.start_server()
+
+    yield heater
+
+    await heater.server.close()
+
+
+@pytest_asyncio.fixture(autouse=True, scope="module", loop_scope="module")
 async def client_session():
-    """Fixture to execute asserts before and after a test is run"""
+    """Fixture to execute asserts before and after a test is run, shared by the tests of a module"""
     # Setup
-    client_session = ClientSession()
+    client_session = ClientSession(connector=TCPConnector(limit=0, ssl=False))
 
     yield client_session
 
@@ -51,13 +150,17 @@ def oil_heater_power_response():
     return load_fixture("oil_heater_power_response.json")
 
 
+@functools.lru_cache(maxsize=None)
 def load_fixture(name: str):
-    """Load a fixture from disk."""
+    """Load a fixture from disk, only once per file.
+
+    JSON fixtures are read-only, since the same instance is shared by all tests.
+    """
     path = pathlib.Path(__file__).parent / "fixtures" / name
 
     content = path.read_text()
 
     if name.endswith(".json"):
-        return json.loads(content)
+        return MappingProxyType(orjson.loads(content))
 
     return content
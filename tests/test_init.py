@@ -1,15 +1,40 @@
 """Test Mill."""
-import json
+import asyncio
+import functools
+import gc
+import itertools
+import time
+from contextlib import nullcontext
+from unittest.mock import Mock, patch
 
 import pytest
-from aiohttp import ClientResponseError
+from aiohttp import ClientConnectionError, ClientResponseError, ContentTypeError
 
-from mill_local import Mill, MillOilHeater, OperationMode, OilHeaterPowerLevels
+from mill_local import CircuitOpenError, Mill, MillOilHeater, OperationMode, OilHeaterPowerLevels, _CircuitState
 
 device_ip = "192.168.2.123"
 local_api_url = f"http://{device_ip}"
 
 
+@pytest.fixture
+def mill(client_session, heater):
+    """A Mill data handler for the fake heater."""
+    return heater.attach(Mill(device_ip, client_session))
+
+
+@pytest.fixture
+def oil_mill(client_session, heater):
+    """A Mill Oil Heater data handler for the fake heater."""
+    return heater.attach(MillOilHeater(device_ip, client_session))
+
+
+# Expected request payloads, built once
+SET_TEMPERATURE_PAYLOAD = {"type": "Normal", "value": 20.5}
+HEATER_POWER_HIGH_PAYLOAD = {"heating_level_percentage": OilHeaterPowerLevels.HIGH.value}
+MODE_OFF_PAYLOAD = {"mode": OperationMode.OFF.value}
+MODE_CONTROL_INDIVIDUALLY_PAYLOAD = {"mode": OperationMode.CONTROL_INDIVIDUALLY.value}
+
+
 async def test_init_when_websession_is_present(client_session):
     """Test Mill init and default values."""
     mill = Mill(device_ip, client_session)
@@ -24,10 +49,75 @@ async def test_init_when_websession_is_present(client_session):
     assert mill.mac_address is None
 
 
-async def test_connect_when_successful(mocked_response, client_session, status_command_response):
+async def test_init_when_device_ip_is_not_an_ip_address(client_session):
+    """Test Mill init fails early for host names."""
+    with pytest.raises(ValueError):
+        Mill("mill.local", client_session)
+
+
+async def test_timeout_adapts_to_latency(mill):
+    """Test the request timeout follows the p95 latency, within the floor and the configured timeout."""
+    assert mill._timeout.get("status").total == 15
+
+    for _ in range(20):
+        mill._timeout.record("status", 0.05)
+    assert mill._timeout.get("status").total == 1.0
+    assert mill._timeout.get("control-status").total == 15
+
+    for _ in range(64):
+        mill._timeout.record("status", 3)
+    assert mill._timeout.get("status").total == 6
+
+    for _ in range(64):
+        mill._timeout.record("status", 30)
+    assert mill._timeout.get("status").total == 15
+
+
+async def test_timeout_widens_after_timed_out_request(heater, mill, status_command_response):
+    """Test a request that times out doubles the adapted timeout, so a retry of a slower response succeeds."""
+    mill._timeout.floor = 0.05
+    for _ in range(20):
+        mill._timeout.record("status", 0.01)
+    assert mill._timeout.get("status").total == 0.05
+
+    heater.get("status", payload=status_command_response, callback=functools.partial(asyncio.sleep, 0.15),
+               repeat=True)
+
+    start = time.monotonic()
+    with patch("mill_local._backoff"):
+        returned_data = await mill.connect()
+
+    assert returned_data["name"] == "Mill panel"
+    # timed out after 0.05 and 0.1 seconds, and succeeded within 0.2 seconds
+    assert heater.calls("GET", "status") == 3
+    assert time.monotonic() - start < 1
+    assert mill._timeout.get("status").total < 1
+
+
+async def test_create_owns_websession():
+    """Test Mill created with its own websession closes it."""
+    mill = Mill.create(device_ip)
+
+    assert mill.url == local_api_url
+    assert mill.websession.connector.limit_per_host == 2
+    assert mill.websession.json_serialize(MODE_OFF_PAYLOAD) == '{"mode":"OFF"}'
+    assert mill.websession.headers["Accept-Encoding"] == "identity"
+    assert not mill.websession.closed
+
+    await mill.close()
+    assert mill.websession.closed
+
+
+async def test_close_keeps_external_websession(mill, client_session):
+    """Test Mill does not close a websession passed by the caller."""
+
+    await mill.close()
+    assert not client_session.closed
+
+
+async def test_connect_when_successful(heater, mill, status_command_response):
     """Test successful connection to Mill device."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.get(f"{local_api_url}/status", status=200, payload=status_command_response)
+    heater.get("status", payload=status_command_response)
     returned_data = await mill.connect()
 
     # assert returned data, we don't bother asserting every response property
@@ -40,228 +130,329 @@ async def test_connect_when_successful(mocked_response, client_session, status_c
     assert mill.mac_address == "13:37:A6:5E:D3:CB"
 
 
-async def test_connect_when_error_raised(mocked_response, client_session):
-    """Test error raised when connecting to Mill device and None returned."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.get(f"{local_api_url}/status", status=400)
+async def test_get_status_is_cached(heater, mill, status_command_response, generic_status_ok_response):
+    """Test the status is cached for a short while and invalidated by writes."""
+    heater.get("status", payload=status_command_response, repeat=True)
+    heater.post("operation-mode", payload=generic_status_ok_response)
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        returned_data = await mill.connect()
-        assert exp_400_info.value.status == 400
-        assert returned_data is None
-        assert mill.name == ""
-        assert mill.version == ""
-        assert mill.mac_address is None
+    await mill.get_status()
+    await mill.get_status()
+    assert heater.calls("GET", "status") == 1
 
+    await mill.set_operation_mode_off()
+    await mill.get_status()
+    assert heater.calls("GET", "status") == 2
 
-async def test_fetch_heater_sensor_when_successful(mocked_response, client_session, control_status_response):
-    """Test successful reading heater and sensor data."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.get(f"{local_api_url}/control-status", status=200, payload=control_status_response)
+    # the cached status expires
+    mill._status_cached_at -= 5
+    await mill.get_status()
+    assert heater.calls("GET", "status") == 3
 
-    returned_data = await mill.fetch_heater_and_sensor_data()
-    assert returned_data is not None
-    # we don't bother asserting every response property
-    assert len(returned_data.keys()) == 11
+    await mill.connect()
+    assert heater.calls("GET", "status") == 4
 
 
-async def test_fetch_heater_sensor_when_error_raised(mocked_response, client_session, control_status_response):
-    """Test error raised when reading heater and sensor data and None returned."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.get(f"{local_api_url}/control-status", status=400)
+async def test_connect_when_error_raised(heater, mill):
+    """Test error raised when connecting to Mill device and no status stored."""
+    heater.get("status", status=400)
 
     with pytest.raises(ClientResponseError) as exp_400_info:
-        returned_data = await mill.fetch_heater_and_sensor_data()
-        assert exp_400_info.value.status == 400
-        assert returned_data is None
+        await mill.connect()
 
+    assert exp_400_info.value.status == 400
+    assert mill.name == ""
+    assert mill.version == ""
+    assert mill.mac_address is None
 
-async def test_set_target_temperature_when_successful(mocked_response, client_session,
-                                                      generic_status_ok_response):
-    """Test successful setting the device target temperature."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/set-temperature", status=200, payload=generic_status_ok_response)
 
-    returned_data = await mill.set_target_temperature(20.5)
-    assert returned_data is None
-    mocked_response.assert_called_once_with(url=f"{local_api_url}/set-temperature",
-                                            method="POST",
-                                            data=json.dumps({
-                                                "type": "Normal",
-                                                "value": 20.5
-                                            }))
+async def test_connect_retries_on_connection_error(heater, mill, status_command_response):
+    """Test connection errors are retried with backoff before giving up."""
+    heater.get("status", disconnect=True, repeat=True)
 
+    async def heater_recovers(delay):
+        # aiohttp may retry a dropped GET itself, so the heater recovers after a given number of backoffs instead
+        # of a given number of requests
+        if mocked_backoff.call_count == 2:
+            heater.clear()
+            heater.get("status", payload=status_command_response)
 
-async def test_set_target_temperature_when_error_raised(mocked_response, client_session,
-                                                        generic_status_ok_response):
-    """Test error raised when setting the device target temperature."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/set-temperature", status=400)
+    with patch("mill_local._backoff", side_effect=heater_recovers) as mocked_backoff:
+        returned_data = await mill.connect()
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        returned_data = await mill.set_target_temperature(20.5)
-        assert exp_400_info.value.status == 400
-        assert returned_data is None
-        mocked_response.assert_called_once_with(url=f"{local_api_url}/set-temperature",
-                                                method="POST",
-                                                data=json.dumps({
-                                                    "type": "Normal",
-                                                    "value": 20.5
-                                                }))
-
-async def test_set_heater_power_when_successful(mocked_response, client_session,
-                                                      generic_status_ok_response):
-    """Test successful setting the device oil heater power."""
-    mill = MillOilHeater(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/oil-heater-power", status=200, payload=generic_status_ok_response)
-
-    returned_data = await mill.set_heater_power(OilHeaterPowerLevels.HIGH)
-    assert returned_data is None
-    mocked_response.assert_called_once_with(url=f"{local_api_url}/oil-heater-power",
-                                            method="POST",
-                                            data=json.dumps({
-                                                "heating_level_percentage": OilHeaterPowerLevels.HIGH.value,
-                                            }))
-
-
-async def test_set_heater_power_when_error_raised(mocked_response, client_session,
-                                                        generic_status_ok_response):
-    """Test error raised when setting the device oil heater power."""
-    mill = MillOilHeater(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/oil-heater-power", status=400)
+    assert returned_data["name"] == "Mill panel"
+    assert mocked_backoff.call_count == 2
+    # first backoff is capped by the base delay
+    assert 0 <= mocked_backoff.call_args_list[0].args[0] <= 0.1
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        returned_data = await mill.set_heater_power(OilHeaterPowerLevels.HIGH)
-        assert exp_400_info.value.status == 400
-        assert returned_data is None
-        mocked_response.assert_called_once_with(url=f"{local_api_url}/oil-heater-power",
-                                                method="POST",
-                                                data=json.dumps({
-                                                    "heating_level_percentage": OilHeaterPowerLevels.HIGH.value,
-                                                }))
 
+async def test_connect_gives_up_after_retries(heater, mill):
+    """Test the last connection error is raised when all attempts fail."""
+    heater.get("status", disconnect=True, repeat=True)
 
-async def test_fetch_heater_power_when_successful(mocked_response, client_session, oil_heater_power_response):
-    """Test successful reading heater and sensor data."""
-    mill = MillOilHeater(device_ip, client_session)
-    mocked_response.get(f"{local_api_url}/oil-heater-power", status=200, payload=oil_heater_power_response)
+    with patch("mill_local._backoff") as mocked_backoff:
+        with pytest.raises(ClientConnectionError):
+            await mill.connect()
 
-    returned_data = await mill.fetch_heater_power_data()
-    assert returned_data is not None
-    assert len(returned_data.keys()) == 2
-    assert type(returned_data.get("value")) is int
+    assert mocked_backoff.call_count == 3
+    assert all(0 <= call.args[0] <= 1 for call in mocked_backoff.call_args_list)
 
 
-async def test_fetch_heater_power_when_error_raised(mocked_response, client_session, oil_heater_power_response):
-    """Test error raised when reading heater and sensor data and None returned."""
-    mill = MillOilHeater(device_ip, client_session)
-    mocked_response.get(f"{local_api_url}/oil-heater-power", status=400)
+async def test_connect_retries_share_the_timeout(client_session, heater):
+    """Test retries of a heater that never responds give up within the configured timeout."""
+    mill = heater.attach(Mill(device_ip, client_session, timeout_seconds=0.5))
+    mill._timeout.floor = 0.05
+    for _ in range(20):
+        mill._timeout.record("status", 0.01)
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        returned_data = await mill.fetch_heater_power_data()
-        assert exp_400_info.value.status == 400
-        assert returned_data is None
+    heater.get("status", callback=asyncio.Event().wait, repeat=True)
 
+    start = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        await mill.connect()
 
-async def test_set_operation_mode_control_individually_when_successful(mocked_response, client_session,
-                                                                       generic_status_ok_response):
-    """Test successful setting the device operation mode to 'control individually'."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/operation-mode", status=200, payload=generic_status_ok_response)
+    assert heater.calls("GET", "status") > 1
+    assert time.monotonic() - start < 0.7
 
-    returned_data = await mill.set_operation_mode_control_individually()
-    assert returned_data is None
-    mocked_response.assert_called_once_with(url=f"{local_api_url}/operation-mode",
-                                            method="POST",
-                                            data=json.dumps({
-                                                "mode": OperationMode.CONTROL_INDIVIDUALLY.value
-                                            }))
 
+async def test_circuit_opens_after_repeated_connection_errors(heater, mill, status_command_response):
+    """Test requests fail fast while the heater is not responding, and recover after the cool-down."""
+    heater.get("status", disconnect=True, repeat=True)
 
-async def test_set_operation_mode_control_individually_when_error_raised(mocked_response, client_session,
-                                                                       generic_status_ok_response):
-    """Test error raised when setting the device operation mode to 'control individually'."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/operation-mode", status=400)
+    for _ in range(5):
+        with pytest.raises(ClientConnectionError):
+            await mill._get_request("status")
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        returned_data = await mill.set_operation_mode_control_individually()
-        assert exp_400_info.value.status == 400
-        assert returned_data is None
-        mocked_response.assert_called_once_with(url=f"{local_api_url}/operation-mode",
-                                                method="POST",
-                                                data=json.dumps({
-                                                    "mode": OperationMode.CONTROL_INDIVIDUALLY.value
-                                                }))
+    heater.clear()
+    requests_sent = heater.calls("GET", "status")
+    with pytest.raises(CircuitOpenError):
+        await mill._get_request("status")
+    # short-circuited, so no request was sent
+    assert heater.calls("GET", "status") == requests_sent
+
+    # after the cool-down a single probe is let through, and a successful one closes the circuit
+    heater.get("status", payload=status_command_response)
+    mill._breaker._opened_at -= 30
+    returned_data = await mill._get_request("status")
+    assert returned_data["name"] == "Mill panel"
+    assert mill._breaker.allow()
+
+
+async def test_circuit_lets_single_probe_through_after_cool_down(heater, mill, status_command_response,
+                                                                 control_status_response):
+    """Test only one request probes the heater after the cool-down, and a failed probe opens the circuit again."""
+    for _ in range(5):
+        mill._breaker.record_failure()
+    assert mill._breaker.state is _CircuitState.OPEN
+
+    # a failed probe opens the circuit again
+    heater.get("status", disconnect=True, repeat=True)
+    mill._breaker._opened_at -= 30
+    with pytest.raises(ClientConnectionError):
+        await mill._get_request("status")
+    assert mill._breaker.state is _CircuitState.OPEN
+    with pytest.raises(CircuitOpenError):
+        await mill._get_request("status")
 
+    # of two concurrent requests after the cool-down, only one reaches the heater
+    heater.clear()
+    heater.get("status", payload=status_command_response)
+    heater.get("control-status", payload=control_status_response)
+    requests_sent = len(heater.requests)
+    mill._breaker._opened_at -= 30
+    results = await asyncio.gather(
+        mill._get_request("status"), mill._get_request("control-status"), return_exceptions=True
+    )
 
-async def test_set_operation_mode_off_when_successful(mocked_response, client_session, generic_status_ok_response):
-    """Test successful setting the device operation mode to 'off'."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/operation-mode", status=200, payload=generic_status_ok_response)
+    assert len(heater.requests) == requests_sent + 1
+    assert sum(isinstance(result, CircuitOpenError) for result in results) == 1
+    assert sum(isinstance(result, dict) for result in results) == 1
+    assert mill._breaker.state is _CircuitState.CLOSED
 
-    returned_data = await mill.set_operation_mode_off()
-    assert returned_data is None
-    mocked_response.assert_called_once_with(url=f"{local_api_url}/operation-mode",
-                                            method="POST",
-                                            data=json.dumps({
-                                                "mode": OperationMode.OFF.value
-                                            }))
 
+async def test_fetch_heater_sensor_concurrent_callers_share_request(heater, mill, control_status_response):
+    """Test concurrent callers are served by a single request to the device."""
+    heater.get("control-status", payload=control_status_response, repeat=True)
 
-async def test_set_operation_mode_off_when_error_raised(mocked_response, client_session, generic_status_ok_response):
-    """Test error raised when setting the device operation mode to 'off'."""
-    mill = Mill(device_ip, client_session)
-    mocked_response.post(f"{local_api_url}/operation-mode", status=400)
+    first, second = await asyncio.gather(mill.fetch_heater_and_sensor_data(), mill.fetch_heater_and_sensor_data())
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        returned_data = await mill.set_operation_mode_off()
-        assert exp_400_info.value.status == 400
-        assert returned_data is None
-        mocked_response.assert_called_once_with(url=f"{local_api_url}/operation-mode",
-                                                method="POST",
-                                                data=json.dumps({
-                                                    "mode": OperationMode.OFF.value
-                                                }))
+    assert first == second == control_status_response
+    assert heater.calls("GET", "control-status") == 1
+    assert not mill._inflight
 
 
-async def test_post_request_rais_error_on_400_and_500(mocked_response, client_session):
-    """Test that get_request rais exception when status 400 or higher."""
-    mill = Mill(device_ip, client_session)
-    # with response body
-    mocked_response.post(f"{local_api_url}/operation-mode", status=400, body=json.dumps({
-        "status": "Failed to parse message body"
-    }))
-    # without response body
-    mocked_response.post(f"{local_api_url}/operation-mode", status=500)
+async def test_get_request_error_after_cancelled_caller_is_retrieved(heater, mill):
+    """Test the error of a request is not reported as never retrieved when its only caller was cancelled."""
+    heater.get("status", status=500, callback=functools.partial(asyncio.sleep, 0.05))
+    loop = asyncio.get_running_loop()
+    exception_handler = Mock()
+    loop.set_exception_handler(exception_handler)
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        await mill._post_request(command="operation-mode", payload={"mode": OperationMode.OFF.value})
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(mill._get_request("status"), 0.01)
+        task = mill._inflight["status"]
+        await asyncio.wait([task])
+        del task
+        gc.collect()
+    finally:
+        loop.set_exception_handler(None)
 
-    assert exp_400_info.value.status == 400
+    assert not mill._inflight
+    exception_handler.assert_not_called()
 
-    with pytest.raises(ClientResponseError) as exp_500_info:
-        await mill._post_request(command="operation-mode", payload={"mode": OperationMode.OFF.value})
 
-    assert exp_500_info.value.status == 500
+async def test_fetch_all_when_successful(heater, mill, status_command_response, control_status_response):
+    """Test reading status and heater data in one go."""
+    heater.get("status", payload=status_command_response)
+    heater.get("control-status", payload=control_status_response)
 
+    status, control_status = await mill.fetch_all()
 
-async def test_get_request_rais_error_on_400_and_500(mocked_response, client_session):
-    """Test that get_request rais exception when status 400 or higher."""
-    mill = Mill(device_ip, client_session)
-    # with response body
-    mocked_response.get(f"{local_api_url}/status", status=400, body=json.dumps({
-        "status": "Failed to parse message body"
-    }))
-    # without response body
-    mocked_response.get(f"{local_api_url}/status", status=500)
+    assert status == status_command_response
+    assert control_status == control_status_response
+    assert mill.name == "Mill panel"
 
-    with pytest.raises(ClientResponseError) as exp_400_info:
-        await mill._get_request("status")
 
-    assert exp_400_info.value.status == 400
+async def test_set_target_temperature_skips_unchanged_value(heater, mill, generic_status_ok_response,
+                                                            control_status_response):
+    """Test setting the same target temperature again is skipped until the device state may have changed."""
+    heater.post("set-temperature", payload=generic_status_ok_response, repeat=True)
+    heater.post("operation-mode", payload=generic_status_ok_response)
+    heater.get("control-status", payload=control_status_response)
+
+    await mill.set_target_temperature(20.5)
+    await mill.set_target_temperature(20.5)
+    assert heater.calls("POST", "set-temperature") == 1
+
+    await mill.set_operation_mode_control_individually()
+    await mill.set_target_temperature(20.5)
+    assert heater.calls("POST", "set-temperature") == 2
+
+    # the device reports another target temperature
+    await mill.fetch_heater_and_sensor_data()
+    await mill.set_target_temperature(20.5)
+    assert heater.calls("POST", "set-temperature") == 3
+
+
+GET_CASES = [
+    ("mill", Mill.fetch_heater_and_sensor_data, "control-status", "control_status_response"),
+    ("oil_mill", MillOilHeater.fetch_heater_power_data, "oil-heater-power", "oil_heater_power_response"),
+]
+
+POST_CASES = [
+    ("mill", Mill.set_target_temperature, (20.5,), "set-temperature", SET_TEMPERATURE_PAYLOAD),
+    ("oil_mill", MillOilHeater.set_heater_power, (OilHeaterPowerLevels.HIGH,), "oil-heater-power",
+     HEATER_POWER_HIGH_PAYLOAD),
+    ("mill", Mill.set_operation_mode_control_individually, (), "operation-mode", MODE_CONTROL_INDIVIDUALLY_PAYLOAD),
+    ("mill", Mill.set_operation_mode_off, (), "operation-mode", MODE_OFF_PAYLOAD),
+]
+
+
+@pytest.mark.parametrize("status", [200, 400])
+@pytest.mark.parametrize("mill_fixture,method,command,fixture_name", GET_CASES,
+                         ids=[case[1].__name__ for case in GET_CASES])
+async def test_get_commands(request, heater, mill_fixture, method, command, fixture_name, status):
+    """Test reading device data, both successfully and when an error is raised."""
+    mill = request.getfixturevalue(mill_fixture)
+    expected_data = request.getfixturevalue(fixture_name)
+    heater.get(command, status=status, payload=expected_data if status < 400 else None)
+
+    with pytest.raises(ClientResponseError) if status >= 400 else nullcontext() as exp_info:
+        returned_data = await method(mill)
+
+    if status >= 400:
+        assert exp_info.value.status == status
+    else:
+        assert returned_data == expected_data
+
+
+@pytest.mark.parametrize("status", [200, 400])
+@pytest.mark.parametrize("mill_fixture,method,args,command,expected_payload", POST_CASES,
+                         ids=[case[1].__name__ for case in POST_CASES])
+async def test_post_commands(request, heater, generic_status_ok_response, mill_fixture, method, args, command,
+                             expected_payload, status):
+    """Test setting device values, both successfully and when an error is raised."""
+    mill = request.getfixturevalue(mill_fixture)
+    heater.post(command, status=status, payload=generic_status_ok_response if status < 400 else None)
+
+    with pytest.raises(ClientResponseError) if status >= 400 else nullcontext() as exp_info:
+        returned_data = await method(mill, *args)
+
+    if status >= 400:
+        assert exp_info.value.status == status
+    else:
+        assert returned_data is None
+    assert heater.requests == [("POST", command, "application/json", expected_payload)]
+
+
+async def test_get_request_raise_error_on_non_json_error_body(heater, mill):
+    """Test that the HTTP error is raised when the error body is not JSON."""
+    heater.get("status", status=500, body="<html>Internal Server Error</html>", content_type="text/html")
 
     with pytest.raises(ClientResponseError) as exp_500_info:
         await mill._get_request("status")
 
     assert exp_500_info.value.status == 500
+
+
+async def test_get_request_raise_error_on_non_json_body(heater, mill):
+    """Test that a successful response with a body that is not JSON raises a ClientResponseError."""
+    heater.get("status", body="<html>Mill panel</html>", content_type="text/html")
+    for _ in range(5):
+        mill._breaker.record_failure()
+    mill._breaker._opened_at -= 30
+
+    with pytest.raises(ContentTypeError) as exp_info:
+        await mill._get_request("status")
+
+    assert exp_info.value.status == 200
+    # the heater did respond, so the probe closes the circuit
+    assert mill._breaker.state is _CircuitState.CLOSED
+
+
+@pytest.mark.parametrize("body", [b"", b"null"], ids=["empty", "null"])
+async def test_get_request_when_body_is_missing(heater, mill, body):
+    """Test that a successful response without data returns an empty status."""
+    heater.get("control-status", body=body)
+
+    assert await mill.fetch_heater_and_sensor_data() == {"status": ""}
+
+
+async def test_concurrent_requests_are_limited(heater, mill, generic_status_ok_response):
+    """Test no more than two requests are sent to the device at the same time."""
+    active = 0
+    max_active = 0
+
+    async def slow_response():
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+
+    heater.post("operation-mode", payload=generic_status_ok_response, callback=slow_response, repeat=True)
+
+    await asyncio.gather(*(
+        mill._post_request(command="operation-mode", payload=MODE_OFF_PAYLOAD) for _ in range(5)
+    ))
+
+    assert max_active == 2
+
+
+ERROR_REQUESTS = {
+    "GET": ("status", lambda mill: mill._get_request("status")),
+    "POST": ("operation-mode", lambda mill: mill._post_request(command="operation-mode", payload=MODE_OFF_PAYLOAD)),
+}
+
+
+@pytest.mark.parametrize("verb,status,with_body", list(itertools.product(["GET", "POST"], [400, 500], [True, False])))
+async def test_request_raise_error_on_400_and_500(heater, mill, verb, status, with_body):
+    """Test that requests raise exception when status 400 or higher, with or without a response body."""
+    command, send_request = ERROR_REQUESTS[verb]
+    heater.add(verb, command, status=status,
+               payload={"status": "Failed to parse message body"} if with_body else None)
+
+    with pytest.raises(ClientResponseError) as exp_info:
+        await send_request(mill)
+
+    assert exp_info.value.status == status